@@ -1,11 +1,14 @@
 import streamlit as st
 import json
-import requests
-import pandas as pd
-import altair as alt
-import google.auth
-import google.auth.transport.requests
-from google.oauth2 import service_account
+import time
+from datetime import datetime, timedelta
+
+from chat_streamer import stream_chat_response
+from theme import add_custom_css
+
+# altair and the google-auth stack are imported lazily inside the
+# functions that need them; both are heavyweight and would otherwise be
+# paid on every cold start.
 
 # --- Configuration ---
 st.set_page_config(
@@ -15,193 +18,20 @@ st.set_page_config(
 )
 
 # --- Theme ---
-def add_custom_css():
-    """
-    Injects custom CSS to apply the new theme based on the provided
-    Tailwind/shadcn variable definitions.
-    """
-    st.markdown(
-        """
-        <style>
-            /* 1. Import Poppins Font */
-            @import url('https://fonts.googleapis.com/css2?family=Poppins:ital,wght@0,100;0,200;0,300;0,400;0,500;0,600;0,700;0,800;0,900;1,100;1,200;1,300;1,400;1,500;1,600;1,700;1,800;1,900&display=swap');
-
-            /* 2. Define the core variables from your file */
-            :root {
-                --background: oklch(1.0000 0 0);
-                --foreground: oklch(0.1408 0.0044 285.8229);
-                --primary: oklch(0.7879 0.1991 139.5227);
-                --primary-foreground: oklch(1.0000 0 0);
-                --secondary: oklch(0.9579 0.0013 106.4242);
-                --secondary-foreground: oklch(0.2163 0.0435 230.7774);
-                --muted: oklch(0.9674 0.0013 286.3752);
-                --muted-foreground: oklch(0.3730 0.0340 259.7330);
-                --border: oklch(0.9197 0.0040 286.3202);
-                --radius: 0.625rem;
-                --sidebar: oklch(0.9851 0 0);
-                --sidebar-foreground: oklch(0.1408 0.0044 285.8229);
-                --font-sans: 'Poppins', sans-serif;
-            }
-            
-            /* Hide sidebar */
-            [data-testid="stSidebar"] {
-                display: none;
-            }
-            
-            /* Adjust main app margin now that sidebar is gone */
-            .main .block-container {
-                max-width: 100%;
-                padding-left: 2rem;
-                padding-right: 2rem;
-            }
-
-            /* 3. Apply the theme to Streamlit components */
-            
-            body {
-                font-family: var(--font-sans);
-            }
-
-            /* Main app background */
-            .stApp {
-                background-color: var(--background);
-                color: var(--foreground);
-                font-family: var(--font-sans);
-            }
-
-            /* Main Title */
-            h1 {
-                color: var(--foreground);
-                font-family: var(--font-sans);
-            }
-            
-            /* Main caption */
-            .stApp > .main .block-container div[data-testid="stMarkdown"] p {
-                color: var(--muted-foreground);
-            }
-            
-            /* Clear chat button */
-            .stButton>button {
-                background-color: var(--primary);
-                color: var(--primary-foreground);
-                border: none;
-                border-radius: var(--radius);
-                padding: 0.25rem 0.75rem;
-                font-size: 0.875rem;
-            }
-            .stButton>button:hover {
-                background-color: var(--primary);
-                opacity: 0.85;
-                color: var(--primary-foreground);
-                border: none;
-            }
-
-            /* Chat Messages */
-            [data-testid="stChatMessage"] {
-                background-color: var(--secondary); /* Assistant message */
-                border-radius: var(--radius);
-                border: 1px solid var(--border);
-                color: var(--secondary-foreground);
-            }
-            [data-testid="stChatMessage"][data-user-message="true"] {
-                background-color: var(--muted); /* User message */
-                border: 1px solid var(--border);
-                color: var(--muted-foreground);
-            }
-            
-            /* Auth warning */
-            [data-testid="stWarning"] {
-                background-color: oklch(0.98 0.09 90); /* Light yellow */
-                border-color: oklch(0.8 0.1 90); /* Darker yellow border */
-                border-radius: var(--radius);
-                padding: 1rem;
-            }
-            [data-testid="stWarning"] code {
-                background-color: oklch(0.9 0.05 90);
-                padding: 2px 5px;
-                border-radius: 4px;
-            }
-
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
-
 add_custom_css()
 
 
-# --- Helper Functions from Notebook ---
-
-def is_json(myjson):
-    """Checks if a string is valid JSON."""
-    try:
-        json.loads(myjson)
-    except ValueError:
-        return False
-    return True
-
-def get_property(data, field_name, default=""):
-    """Safely gets a property from a dictionary."""
-    return data.get(field_name, default)
-
-def format_bq_table_ref(table_ref):
-    """Formats a BigQuery table reference."""
-    return "{}.{}.{}".format(
-        table_ref.get("projectId", "unknown-project"),
-        table_ref.get("datasetId", "unknown-dataset"),
-        table_ref.get("tableId", "unknown-table")
-    )
-
-def format_looker_table_ref(table_ref):
-    """Formats a Looker table reference."""
-    return "lookmlModel: {}, explore: {}".format(
-        table_ref.get("lookmlModel", "unknown-model"),
-        table_ref.get("explore", "unknown-explore")
-    )
-
-def parse_schema_to_dataframe(datasources):
-    """Parses schema information into DataFrames for display."""
-    dfs = []
-    for datasource in datasources:
-        source_name = ""
-        if "studioDatasourceId" in datasource:
-            source_name = f"Looker Studio: {datasource['studioDatasourceId']}"
-        elif "lookerExploreReference" in datasource:
-            source_name = f"Looker: {format_looker_table_ref(datasource['lookerExploreReference'])}"
-        else:
-            source_name = f"BigQuery: {format_bq_table_ref(datasource['bigqueryTableReference'])}"
-        
-        fields = datasource.get("schema", {}).get("fields", [])
-        df = pd.DataFrame(
-            {
-                "Column": [get_property(f, "name") for f in fields],
-                "Type": [get_property(f, "type") for f in fields],
-                "Description": [get_property(f, "description", "-") for f in fields],
-                "Mode": [get_property(f, "mode") for f in fields],
-            }
-        )
-        dfs.append((source_name, df))
-    return dfs
-
-def parse_data_to_dataframe(result):
-    """Parses data result into a DataFrame."""
-    fields = [get_property(f, "name") for f in result.get("schema", {}).get("fields", [])]
-    data = result.get("data", [])
-    
-    # Create a dictionary of lists for the DataFrame
-    data_dict = {}
-    for field in fields:
-        data_dict[field] = [get_property(el, field) for el in data]
-        
-    return pd.DataFrame(data_dict)
-
 # --- Authentication ---
 
-@st.cache_data(ttl=3000) # Cache token for 50 minutes
-def get_access_token():
+@st.cache_resource
+def get_credentials():
     """
-    Gets the Google Cloud access token using service account keys
-    stored as individual Streamlit Secrets.
+    Builds service-account credentials from the individual Streamlit
+    Secrets once per process. The Credentials object tracks its own
+    token and expiry, so reruns never redo the secrets parsing.
     """
+    from google.oauth2 import service_account
+
     try:
         # Check for the minimal required keys
         required_keys = ["type", "project_id", "private_key", "client_email"]
@@ -228,118 +58,109 @@ def get_access_token():
         
         scopes = ["https://www.googleapis.com/auth/cloud-platform"]
         
-        credentials = service_account.Credentials.from_service_account_info(
+        return service_account.Credentials.from_service_account_info(
             creds_dict, scopes=scopes
         )
-        
-        auth_req = google.auth.transport.requests.Request()
-        credentials.refresh(auth_req)
-        
+
+    except Exception as e:
+        st.error(f"Error building credentials from service account secrets: {e}")
+        st.stop()
+
+@st.cache_resource
+def _auth_request():
+    """
+    Shared transport for token refreshes. google-auth's Request wraps a
+    requests session, so reusing one keeps its connection pool warm
+    instead of rebuilding it on every refresh.
+    """
+    import google.auth.transport.requests
+
+    return google.auth.transport.requests.Request()
+
+def get_access_token():
+    """
+    Returns a valid access token, refreshing the cached credentials
+    only when the current token is missing or close to expiry.
+    """
+    credentials = get_credentials()
+    try:
+        expiring_soon = (
+            credentials.expiry is not None
+            and credentials.expiry - datetime.utcnow() < timedelta(minutes=5)
+        )
+        if not credentials.valid or expiring_soon:
+            credentials.refresh(_auth_request())
+
         return credentials.token
-    
+
     except Exception as e:
         st.error(f"Error getting auth token from service account secrets: {e}")
         st.stop()
 
-# --- Streaming Chat Function ---
+# --- Render caching ---
 
-def stream_chat_response(chat_url, payload, headers):
+@st.cache_data(show_spinner=False)
+def _chart_from_spec(spec_json):
     """
-    A generator function to stream and parse the chat response.
-    This adapts the `get_stream_multi_turn` logic from the notebook.
-    It yields structured dictionaries for easy rendering in Streamlit.
+    Compiles a vega spec into an Altair chart once per unique spec.
+    History replay re-runs on every interaction, so without this every
+    rerun re-parses every chart's JSON from scratch. cache_data hands
+    each caller its own copy, so a rerun can't mutate the cached chart.
     """
-    s = requests.Session()
-    acc = ""  # JSON accumulator
-    latest_data_rows = None
+    import altair as alt
 
-    try:
-        with s.post(chat_url, json=payload, headers=headers, stream=True, timeout=600) as resp:
-            if resp.status_code != 200:
-                yield {"type": "error", "content": f"API Error {resp.status_code}: {resp.text}"}
-                return
-
-            for line in resp.iter_lines():
-                if not line:
-                    continue
-
-                decoded_line = str(line, encoding="utf-8")
-
-                if decoded_line == "[{":
-                    acc = "{"
-                elif decoded_line == "}]":
-                    acc += "}"
-                elif decoded_line == ",":
-                    continue
-                else:
-                    acc += decoded_line
+    return alt.Chart.from_dict(json.loads(spec_json))
 
-                if not is_json(acc):
-                    continue
+@st.cache_resource
+def _df_store():
+    """
+    Process-wide store for result DataFrames referenced from history.
+    History chunks keep an 8-byte key instead of the frame itself, so
+    old turns cost O(1) session-state memory.
+    """
+    return {}
 
-                # --- Valid JSON object received ---
-                data_json = json.loads(acc)
-                
-                # Yield the raw API message for context
-                yield {"type": "api_message", "content": data_json}
+def _store_df(df):
+    """Stores a DataFrame and returns the key to reference it by."""
+    import hashlib
 
-                if "error" in data_json:
-                    err = data_json["error"]
-                    yield {"type": "error", "content": f"Code: {err.get('code')}\nMessage: {err.get('message')}"}
-                    continue
+    import pandas as pd
 
-                if "systemMessage" not in data_json:
-                    continue
+    digest = hashlib.blake2b(
+        pd.util.hash_pandas_object(df, index=True).values.tobytes(),
+        digest_size=8,
+    ).hexdigest()
+    _df_store()[digest] = df
+    return digest
 
-                msg = data_json["systemMessage"]
-    
-                  # Handle different message types
-                if "text" in msg:
-                    yield {"type": "text", "content": "".join(msg["text"]["parts"])}
-                elif "schema" in msg:
-                    if "query" in msg["schema"]:
-                        yield {"type": "text", "content": f"**Resolving schema for:** *{msg['schema']['query']['question']}*"}
-                    elif "result" in msg["schema"]:
-                        yield {"type": "text", "content": "**Schema resolved. Data sources:**"}
-                        dfs = parse_schema_to_dataframe(msg["schema"]["result"]["datasources"])
-                        for source_name, df in dfs:
-                            yield {"type": "text", "content": f"**{source_name}**"}
-                            yield {"type": "dataframe", "content": df}
-                elif "data" in msg:
-                    if "query" in msg["data"]:
-                        query = msg["data"]["query"]
-                        yield {"type": "text", "content": f"**Retrieval Query:** *{query['question']}*"}
-                    elif "generatedSql" in msg["data"]:
-                        yield {"type": "text", "content": "**Generated SQL:**"}
-                        yield {"type": "sql", "content": msg["data"]["generatedSql"]}
-                    elif "result" in msg["data"]:
-                        yield {"type": "text", "content": "**Data retrieved:**"}
-                        df = parse_data_to_dataframe(msg["data"]["result"])
-                        latest_data_rows = msg["data"]["result"].get("data", [])
-                        yield {"type": "dataframe", "content": df}
-                elif "chart" in msg:
-                    if "query" in msg["chart"]:
-                        yield {"type": "text", "content": f"**Generating chart for:** *{msg['chart']['query']['instructions']}*"}
-                    elif "result" in msg["chart"]:
-                        yield {"type": "text", "content": "**Chart generated:**"}
-                        spec = msg["chart"]["result"]["vegaConfig"]
-                        if latest_data_rows is not None:
-                            data_key = spec.get("data", {}).get("name")
-                            if data_key:
-                                if "datasets" not in spec:
-                                    spec["datasets"] = {}
-                                spec["datasets"][data_key] = latest_data_rows
-                            else: 
-                                spec["data"] = {"values": latest_data_rows}
-                            latest_data_rows = None
-                        yield {"type": "chart", "content": spec}
-                  
-                acc = ""  # Reset accumulator
-
-    except requests.exceptions.RequestException as e:
-        yield {"type": "error", "content": f"Request failed: {e}"}
-    except Exception as e:
-        yield {"type": "error", "content": f"An unexpected error occurred: {e}"}
+def _lookup_df(key):
+    """Fetches a stored DataFrame; None if the store was cleared."""
+    return _df_store().get(key) if key is not None else None
+
+def render_chart(spec, df=None):
+    """
+    Renders a chart spec. When the chunk carries the backing DataFrame,
+    the rows travel to the browser over Streamlit's Arrow path instead
+    of as inline JSON in the spec; otherwise the compiled Altair chart
+    is reused across reruns.
+    """
+    if df is not None:
+        try:
+            st.vega_lite_chart(df, spec, use_container_width=True)
+        except Exception as e:
+            st.error(f"Failed to render chart: {e}")
+        return
+    try:
+        chart = _chart_from_spec(json.dumps(spec, sort_keys=True))
+        st.altair_chart(chart, use_container_width=True)
+    except Exception:
+        # Some altair versions fail to round-trip specs with inline
+        # datasets through Chart.from_dict; hand the raw vega-lite spec
+        # to the frontend instead of dropping the chart.
+        try:
+            st.vega_lite_chart(spec, use_container_width=True)
+        except Exception as e:
+            st.error(f"Failed to render chart: {e}")
 
 
 # --- Streamlit UI ---
@@ -351,13 +172,29 @@ API_VERSION = "v1beta"
 ENVIRONMENT = "prod" # "prod", "autopush", "staging"
 DATA_AGENT_ID = "demo_data_agent_webinar"
 
+# Only the most recent context is sent with each turn; without a bound
+# the request body grows with every message in the conversation.
+MAX_CONTEXT_MESSAGES = 20
+
+# Displayed history is capped too: session state is held in memory per
+# connected tab and replayed on every rerun.
+MAX_HISTORY = 50
+
 # --- Base URL Logic ---
-if ENVIRONMENT == "autopush":
-    base_url = "https://autopush-geminidataanalytics.sandbox.googleapis.com"
-elif ENVIRONMENT == "staging":
-    base_url = "https://staging-geminidataanalytics.sandbox.googleapis.com"
-else:
-    base_url = "https://geminidataanalytics.googleapis.com"
+_BASE_URLS = {
+    "autopush": "https://autopush-geminidataanalytics.sandbox.googleapis.com",
+    "staging": "https://staging-geminidataanalytics.sandbox.googleapis.com",
+    "prod": "https://geminidataanalytics.googleapis.com",
+}
+base_url = _BASE_URLS.get(ENVIRONMENT, _BASE_URLS["prod"])
+
+# Composed once at import; every piece above is a constant.
+CHAT_URL = f"{base_url}/{API_VERSION}/projects/{BILLING_PROJECT}/locations/{LOCATION}:chat"
+PAYLOAD_PARENT = f"projects/{BILLING_PROJECT}/locations/global"
+DATA_AGENT_NAME = f"projects/{BILLING_PROJECT}/locations/{LOCATION}/dataAgents/{DATA_AGENT_ID}"
+
+# Template for per-turn request headers; only Authorization varies.
+_HEADERS_TEMPLATE = {"Content-Type": "application/json"}
 
 
 st.title("📈 Measurelab Data Assistant")
@@ -381,125 +218,151 @@ if "conversation_messages" not in st.session_state:
     st.session_state.conversation_messages = []  # For sending to API
 
 # --- Display chat history ---
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        # The content is a list of chunks (text, df, chart)
-        content_list = message["content"]
-        
-        current_text = ""
-        for item in content_list:
-            if item["type"] == "text":
-                current_text += item["content"]
-            else:
-                # If we have pending text, write it
-                if current_text:
-                    st.markdown(current_text)
-                    current_text = ""
-                
-                # Write the non-text block
-                if item["type"] == "sql":
-                    st.code(item["content"], language="sql")
-                elif item["type"] == "dataframe":
-                    st.dataframe(item["content"])
-                elif item["type"] == "chart":
-                    try:
-                        st.altair_chart(alt.Chart.from_dict(item["content"]), use_container_width=True)
-                    except Exception as e:
-                        st.error(f"Failed to render chart: {e}")
-                elif item["type"] == "error":
-                    st.error(item["content"])
-        
-        # Write any remaining text
-        if current_text:
-            st.markdown(current_text)
-
-# --- Chat Input ---
-if prompt := st.chat_input("Ask your data agent..."):
-    # Get token *only* when user sends a message
-    access_token = get_access_token()
+def _render_history():
+    """Replays the stored chat history."""
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            # The content is a list of chunks (text, df, chart)
+            content_list = message["content"]
+
+            current_text = ""
+            for item in content_list:
+                if item["type"] == "text":
+                    current_text += item["content"]
+                else:
+                    # If we have pending text, write it
+                    if current_text:
+                        st.markdown(current_text)
+                        current_text = ""
+
+                    # Write the non-text block
+                    if item["type"] == "sql":
+                        st.code(item["content"], language="sql")
+                    elif item["type"] == "dataframe":
+                        df = _lookup_df(item.get("key"))
+                        if df is not None:
+                            st.dataframe(df)
+                        else:
+                            st.caption("*(result data no longer cached)*")
+                    elif item["type"] == "chart":
+                        render_chart(item["content"], _lookup_df(item.get("data_key")))
+                    elif item["type"] == "error":
+                        st.error(item["content"])
+
+            # Write any remaining text
+            if current_text:
+                st.markdown(current_text)
+
+# --- Chat panel ---
+@st.fragment
+def chat_panel():
+    """
+    The chat surface: history replay plus the input/streaming flow.
+    Running it as a fragment confines each chat turn's rerun to this
+    block, so the rest of the script (CSS injection, header, config)
+    is not re-executed per message.
+    """
+    _render_history()
+
+    # --- Chat Input ---
+    if prompt := st.chat_input("Ask your data agent..."):
+        # Get token *only* when user sends a message
+        access_token = get_access_token()
     
-    # Check for auth
-    if not access_token:
-        st.error("Authentication failed. Please check the terminal and auth warning.")
-    else:
-        # Add user message to UI
-        st.session_state.messages.append({"role": "user", "content": [{"type": "text", "content": prompt}]})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
-        # Add user message to API context
-        st.session_state.conversation_messages.append({"userMessage": {"text": prompt}})
-
-        # Prepare API request
-        chat_url = f"{base_url}/{API_VERSION}/projects/{BILLING_PROJECT}/locations/{LOCATION}:chat"
-        
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        }
-        
-        chat_payload = {
-            "parent": f"projects/{BILLING_PROJECT}/locations/global",
-            "messages": st.session_state.conversation_messages,
-            "data_agent_context": {
-                "data_agent": f"projects/{BILLING_PROJECT}/locations/{LOCATION}/dataAgents/{DATA_AGENT_ID}",
-            },
-        }
+        # Check for auth
+        if not access_token:
+            st.error("Authentication failed. Please check the terminal and auth warning.")
+        else:
+            # Add user message to UI
+            st.session_state.messages.append({"role": "user", "content": [{"type": "text", "content": prompt}]})
+            with st.chat_message("user"):
+                st.markdown(prompt)
+
+            # Add user message to API context
+            st.session_state.conversation_messages.append({"userMessage": {"text": prompt}})
+
+            # Prepare API request
+            headers = dict(_HEADERS_TEMPLATE, Authorization=f"Bearer {access_token}")
+
+            chat_payload = {
+                "parent": PAYLOAD_PARENT,
+                "messages": st.session_state.conversation_messages[-MAX_CONTEXT_MESSAGES:],
+                "data_agent_context": {
+                    "data_agent": DATA_AGENT_NAME,
+                },
+            }
 
-        # Stream the response
-        with st.chat_message("assistant"):
-            placeholder = st.empty()
-            full_display_list = []  # To store chunks for session state
-            api_context_list = []   # To store API messages for context
-            
-            generator = stream_chat_response(chat_url, chat_payload, headers)
-            
-            current_text = "" # Accumulator for text chunks
-
-            for chunk in generator:
-                if chunk["type"] == "api_message":
-                    api_context_list.append(chunk["content"])
-                    continue
-
-                # Add to display list
-                full_display_list.append(chunk)
-                
-                # Render all content for this turn so far
-                if chunk["type"] == "text":
-                    current_text += chunk["content"]
-                    with placeholder.container():
-                        st.markdown(current_text)
-                
-                else:
-                    # A non-text chunk is about to be rendered.
-                    # First, render any text that was accumulated *before* it.
-                    with placeholder.container():
+            # Stream the response. Rendering is append-only: text updates in
+            # place in its own slot and every non-text chunk is drawn exactly
+            # once, so earlier dataframes/charts are never re-rendered as new
+            # chunks arrive.
+            with st.chat_message("assistant"):
+                text_slot = st.empty()      # Updated in place as text streams in
+                full_display_list = []  # To store chunks for session state
+                api_context_list = []   # To store API messages for context
+
+                generator = stream_chat_response(CHAT_URL, chat_payload, headers, api_context_list)
+
+                current_text = "" # Accumulator for text chunks
+                last_flush = 0.0  # Throttle text repaints to ~20 Hz
+
+                for chunk in generator:
+                    # Add to display list. DataFrames go into history as
+                    # store keys, not inline frames (see _df_store).
+                    if chunk["type"] == "dataframe":
+                        full_display_list.append(
+                            {"type": "dataframe", "key": _store_df(chunk["content"])}
+                        )
+                    elif chunk["type"] == "chart" and "data" in chunk:
+                        full_display_list.append(
+                            {
+                                "type": "chart",
+                                "content": chunk["content"],
+                                "data_key": _store_df(chunk["data"]),
+                            }
+                        )
+                    else:
+                        full_display_list.append(chunk)
+
+                    if chunk["type"] == "text":
+                        current_text += chunk["content"]
+                        now = time.monotonic()
+                        if now - last_flush > 0.05:
+                            text_slot.markdown(current_text)
+                            last_flush = now
+
+                    else:
+                        # Flush any text still pending from the throttle
+                        # before freezing this slot.
                         if current_text:
-                            st.markdown(current_text) # Write pending text
-                        
-                        # Now render the non-text chunk
+                            text_slot.markdown(current_text)
+
+                        # Draw the non-text chunk once; any accumulated text
+                        # stays frozen in its slot above it.
                         if chunk["type"] == "sql":
                             st.code(chunk["content"], language="sql")
                         elif chunk["type"] == "dataframe":
                             st.dataframe(chunk["content"])
                         elif chunk["type"] == "chart":
-                            try:
-                                st.altair_chart(alt.Chart.from_dict(chunk["content"]), use_container_width=True)
-                            except Exception as e:
-                                st.error(f"Failed to render chart: {e}")
+                            render_chart(chunk["content"], chunk.get("data"))
                         elif chunk["type"] == "error":
                             st.error(chunk["content"])
-                    
-                    # Reset the text accumulator and the placeholder
-                    current_text = ""
-                    placeholder = st.empty()
 
-            # After the loop, if there's any remaining text,
-            # ensure it's rendered.
-            if current_text:
-                with placeholder.container():
-                    st.markdown(current_text)
+                        # Start a fresh text slot below the chunk just drawn
+                        current_text = ""
+                        text_slot = st.empty()
 
-        # Add the final accumulated message to session state
-        st.session_state.messages.append({"role": "assistant", "content": full_display_list})
-        st.session_state.conversation_messages.extend(api_context_list)
+                # Final flush for text the throttle was still holding back
+                if current_text:
+                    text_slot.markdown(current_text)
+
+            # Add the final accumulated message to session state, keeping
+            # both histories bounded
+            st.session_state.messages.append({"role": "assistant", "content": full_display_list})
+            st.session_state.messages = st.session_state.messages[-MAX_HISTORY:]
+            st.session_state.conversation_messages.extend(api_context_list)
+            st.session_state.conversation_messages = (
+                st.session_state.conversation_messages[-MAX_CONTEXT_MESSAGES:]
+            )
+
+chat_panel()
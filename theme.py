@@ -0,0 +1,113 @@
+"""Theme styling for the Measurelab Data Assistant app."""
+
+import streamlit as st
+
+_CSS = """
+        <style>
+            /* 1. Import Poppins Font */
+            @import url('https://fonts.googleapis.com/css2?family=Poppins:ital,wght@0,100;0,200;0,300;0,400;0,500;0,600;0,700;0,800;0,900;1,100;1,200;1,300;1,400;1,500;1,600;1,700;1,800;1,900&display=swap');
+
+            /* 2. Define the core variables from your file */
+            :root {
+                --background: oklch(1.0000 0 0);
+                --foreground: oklch(0.1408 0.0044 285.8229);
+                --primary: oklch(0.7879 0.1991 139.5227);
+                --primary-foreground: oklch(1.0000 0 0);
+                --secondary: oklch(0.9579 0.0013 106.4242);
+                --secondary-foreground: oklch(0.2163 0.0435 230.7774);
+                --muted: oklch(0.9674 0.0013 286.3752);
+                --muted-foreground: oklch(0.3730 0.0340 259.7330);
+                --border: oklch(0.9197 0.0040 286.3202);
+                --radius: 0.625rem;
+                --sidebar: oklch(0.9851 0 0);
+                --sidebar-foreground: oklch(0.1408 0.0044 285.8229);
+                --font-sans: 'Poppins', sans-serif;
+            }
+            
+            /* Hide sidebar */
+            [data-testid="stSidebar"] {
+                display: none;
+            }
+            
+            /* Adjust main app margin now that sidebar is gone */
+            .main .block-container {
+                max-width: 100%;
+                padding-left: 2rem;
+                padding-right: 2rem;
+            }
+
+            /* 3. Apply the theme to Streamlit components */
+            
+            body {
+                font-family: var(--font-sans);
+            }
+
+            /* Main app background */
+            .stApp {
+                background-color: var(--background);
+                color: var(--foreground);
+                font-family: var(--font-sans);
+            }
+
+            /* Main Title */
+            h1 {
+                color: var(--foreground);
+                font-family: var(--font-sans);
+            }
+            
+            /* Main caption */
+            .stApp > .main .block-container div[data-testid="stMarkdown"] p {
+                color: var(--muted-foreground);
+            }
+            
+            /* Clear chat button */
+            .stButton>button {
+                background-color: var(--primary);
+                color: var(--primary-foreground);
+                border: none;
+                border-radius: var(--radius);
+                padding: 0.25rem 0.75rem;
+                font-size: 0.875rem;
+            }
+            .stButton>button:hover {
+                background-color: var(--primary);
+                opacity: 0.85;
+                color: var(--primary-foreground);
+                border: none;
+            }
+
+            /* Chat Messages */
+            [data-testid="stChatMessage"] {
+                background-color: var(--secondary); /* Assistant message */
+                border-radius: var(--radius);
+                border: 1px solid var(--border);
+                color: var(--secondary-foreground);
+            }
+            [data-testid="stChatMessage"][data-user-message="true"] {
+                background-color: var(--muted); /* User message */
+                border: 1px solid var(--border);
+                color: var(--muted-foreground);
+            }
+            
+            /* Auth warning */
+            [data-testid="stWarning"] {
+                background-color: oklch(0.98 0.09 90); /* Light yellow */
+                border-color: oklch(0.8 0.1 90); /* Darker yellow border */
+                border-radius: var(--radius);
+                padding: 1rem;
+            }
+            [data-testid="stWarning"] code {
+                background-color: oklch(0.9 0.05 90);
+                padding: 2px 5px;
+                border-radius: 4px;
+            }
+
+        </style>
+        """
+
+def add_custom_css():
+    """
+    Injects custom CSS to apply the new theme based on the provided
+    Tailwind/shadcn variable definitions.
+    """
+    st.markdown(_CSS, unsafe_allow_html=True)